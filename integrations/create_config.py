@@ -1,22 +1,120 @@
 #! /usr/bin/env python3
 
-from dataclasses import dataclass, asdict
-from datetime import datetime
-from typing import Any, Dict, List, Optional
-from pprint import pprint
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, is_dataclass
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple, Union
+import hashlib
+import json
+import os
 import sys
+import threading
+import time
 
+if TYPE_CHECKING:
+    import requests
 
-@dataclass
+if sys.version_info < (3, 10):
+    sys.exit("create_config.py requires Python 3.10 or newer")
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the stdlib json module is used when it isn't installed
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # ijson is optional, the whole execution list is parsed when it isn't installed
+    ijson = None
+
+try:
+    import fastjsonschema
+except ImportError:  # fastjsonschema is optional, config sets are only validated by the api when it isn't installed
+    fastjsonschema = None
+
+
+_PLATFORM_URL = "https://api.sev.co/v3/integration-platform/"
+_EXECUTION_URL = "https://api.sev.co/v1/integration/execution"
+
+_MAX_CONCURRENT_REQUESTS = 8
+_TIMEOUT_SECONDS = 10.0
+
+# A single session is shared by every call so the TLS connection to api.sev.co is kept alive and reused.
+# It is created on first use so that importing this module for the models alone doesn't pull in requests
+_session: Optional["requests.Session"] = None
+_session_lock = threading.Lock()
+
+
+def _get_session() -> "requests.Session":
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+
+                # Idempotent GETs are retried with backoff on throttling and gateway errors rather than failing the whole run
+                retry = Retry(total=5,
+                              backoff_factor=0.25,
+                              status_forcelist=(429, 502, 503, 504),
+                              allowed_methods=frozenset(["GET"]),
+                              respect_retry_after_header=True,
+                              raise_on_status=False)  # Hand the final response to raise_for_status once retries run out
+                session = requests.Session()
+                session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=_MAX_CONCURRENT_REQUESTS, max_retries=retry))
+                _session = session
+
+    return _session
+
+
+def _loads(content: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def _dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+# Tokens and target orgs are fixed for a run, so the headers for each combination are built once and shared.
+# Callers must treat the returned dict as read-only
+_headers_cache: Dict[Tuple[str, Optional[str], bool], Dict[str, str]] = {}
+
+
+def _get_headers(token: str, target_org: Optional[str], json_body: bool = False) -> Dict[str, str]:
+    key = (token, target_org, json_body)
+    headers = _headers_cache.get(key)
+    if headers is None:
+        headers = {"Authorization": token}
+        if json_body:
+            headers["Content-Type"] = "application/json"
+        if target_org:
+            headers['X-Sevco-Target-Org'] = target_org
+        _headers_cache[key] = headers
+
+    return headers
+
+
+# Payloads are built by hand in `to_dict` rather than with `asdict` so the auth/connect/settings dicts
+# are passed through by reference instead of being deep-copied before serialization
+@dataclass(slots=True)
 class ConfigSet:
     schema_id: str
     auth: Optional[Dict[str, Any]] = None
     connect: Optional[Dict[str, Any]] = None
     settings: Optional[Dict[str, Any]] = None
 
+    def to_dict(self) -> Dict[str, Any]:
+        return {"schema_id": self.schema_id,
+                "auth": self.auth,
+                "connect": self.connect,
+                "settings": self.settings}
 
-@dataclass
+
+@dataclass(slots=True)
 class CreateIntegrationAccessConfigRequest:
     config_set: ConfigSet
     enabled: bool
@@ -25,26 +123,47 @@ class CreateIntegrationAccessConfigRequest:
     external_console_link: Optional[str] = None
     runner_id: Optional[str] = None
 
+    def to_dict(self) -> Dict[str, Any]:
+        return {"config_set": self.config_set.to_dict(),
+                "enabled": self.enabled,
+                "label": self.label,
+                "contact_info": self.contact_info,
+                "external_console_link": self.external_console_link,
+                "runner_id": self.runner_id}
+
 
-@dataclass
+@dataclass(slots=True)
 class CreateIntegrationConfigRequest:
     access_config_id: str
     config_set: ConfigSet
     enabled: bool
     label: Optional[str] = None
 
+    def to_dict(self) -> Dict[str, Any]:
+        return {"access_config_id": self.access_config_id,
+                "config_set": self.config_set.to_dict(),
+                "enabled": self.enabled,
+                "label": self.label}
+
+
+# Create requests are serialized once here.  Callers submitting the same request repeatedly can encode it up front
+# and pass the bytes as `body=` (with `create_request=None`) to the create functions to skip rebuilding and
+# re-encoding it on every call.  A pre-encoded body is sent as-is and is not validated
+def encode_request(create_request: Union[CreateIntegrationAccessConfigRequest, CreateIntegrationConfigRequest]) -> bytes:
+    return _dumps(create_request.to_dict())
+
 
 # Integration Configurations contain 2 models.  The AccessConfig defines "how" we connect to the source.  eg creds and comms
 # A single access config can be shared across multiple integration configs
-@dataclass
+@dataclass(slots=True, frozen=True)
 class AccessConfig:
     org_id: str
     platform_id: str
     id: str
     config_set: ConfigSet
     enabled: bool
-    created_timestamp: datetime
-    last_updated_timestamp: datetime
+    created_timestamp: str  # ISO-8601
+    last_updated_timestamp: str  # ISO-8601
     runner_id: Optional[str] = None
     label: Optional[str] = None
     contact_info: Optional[str] = None
@@ -52,7 +171,7 @@ class AccessConfig:
 
 
 # The IntegrationConfig defines the "what" we collect from the integration
-@dataclass
+@dataclass(slots=True, frozen=True)
 class IntegrationConfig:
     org_id: str
     platform_id: str
@@ -61,103 +180,287 @@ class IntegrationConfig:
     access_config_id: str
     config_set: ConfigSet
     enabled: bool
-    created_timestamp: datetime
-    last_updated_timestamp: datetime
+    created_timestamp: str  # ISO-8601
+    last_updated_timestamp: str  # ISO-8601
     label: Optional[str] = None
 
 
+# Built positionally in field order to skip keyword-argument matching on every response
+def _build_access_config(params: Dict[str, Any]) -> AccessConfig:
+    return AccessConfig(params['org_id'],
+                        params['platform_id'],
+                        params['id'],
+                        params['config_set'],
+                        params['enabled'],
+                        params['created_timestamp'],
+                        params['last_updated_timestamp'],
+                        params.get('runner_id'),
+                        params.get('label'),
+                        params.get('contact_info'),
+                        params.get('external_console_link'))
+
+
+def _build_integration_config(params: Dict[str, Any]) -> IntegrationConfig:
+    return IntegrationConfig(params['org_id'],
+                             params['platform_id'],
+                             params['integration_id'],
+                             params['id'],
+                             params['access_config_id'],
+                             params['config_set'],
+                             params['enabled'],
+                             params['created_timestamp'],
+                             params['last_updated_timestamp'],
+                             params.get('label'))
+
+
+# Schemas only change when the platform is deployed, so they are cached in-process and on disk for a week.
+# Set SEVCO_NO_CACHE=1 to always fetch them from the api
+_SCHEMA_CACHE_DIR = os.path.expanduser("~/.cache/sevco/schemas")
+_SCHEMA_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+_schema_cache: Dict[Tuple[str, Optional[str], Optional[str]], List[Dict[str, Any]]] = {}
+
+
+def _cached_schemas(platform_id: str,
+                    integration_id: Optional[str],
+                    target_org: Optional[str],
+                    fetch: Callable[[], List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    if os.environ.get("SEVCO_NO_CACHE") == "1":
+        return fetch()
+
+    key = (platform_id, integration_id, target_org)
+    if key in _schema_cache:
+        return _schema_cache[key]
+
+    digest = hashlib.sha256(f"{platform_id}|{integration_id}|{target_org}".encode()).hexdigest()
+    path = os.path.join(_SCHEMA_CACHE_DIR, f"{digest}.json")
+    try:
+        if time.time() - os.path.getmtime(path) < _SCHEMA_CACHE_TTL_SECONDS:
+            with open(path) as f:
+                _schema_cache[key] = json.load(f)
+                return _schema_cache[key]
+    except (OSError, ValueError):
+        pass
+
+    schemas = fetch()
+    _schema_cache[key] = schemas
+    try:
+        os.makedirs(_SCHEMA_CACHE_DIR, exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(schemas, f)
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        pass  # A cache that can't be written just means fetching again next run
+
+    return schemas
+
+
+# Config sets are checked against any schema fetched from the api for their platform/integration during this run
+# before they are posted, so an invalid config fails locally rather than costing a round trip.  Schemas loaded from
+# the disk cache may predate a deploy, so they are never used to reject a config.  Each schema is compiled once on first use
+_fetched_schemas: Dict[Tuple[str, Optional[str], str], Dict[str, Any]] = {}
+_schema_validators: Dict[Tuple[str, Optional[str], str], Optional[Callable[[Dict[str, Any]], Any]]] = {}
+
+
+def _refuse_remote_ref(uri: str) -> Any:
+    raise ValueError(f"remote $ref {uri} is not resolved during local validation")
+
+
+# fastjsonschema fetches any $ref it can't resolve within the schema with urlopen unless a handler claims its scheme.
+# Claiming every scheme keeps validation from making its own network calls
+class _NoRemoteRefHandlers(dict):
+    def __contains__(self, scheme: object) -> bool:
+        return True
+
+    def __getitem__(self, scheme: str) -> Callable[[str], Any]:
+        return _refuse_remote_ref
+
+
+def _register_schemas(platform_id: str, integration_id: Optional[str], schemas: List[Dict[str, Any]]) -> None:
+    for schema in schemas:
+        _fetched_schemas[(platform_id, integration_id, schema['id'])] = schema
+
+
+def _validate_config_set(platform_id: str, integration_id: Optional[str], config_set: ConfigSet) -> None:
+    if fastjsonschema is None:
+        return
+
+    key = (platform_id, integration_id, config_set.schema_id)
+    if key not in _schema_validators:
+        schema = _fetched_schemas.get(key)
+        if schema is None:
+            return
+        try:
+            # Defaults are left to the api, filling them in here would modify the caller's config set
+            _schema_validators[key] = fastjsonschema.compile(schema, handlers=_NoRemoteRefHandlers(), use_default=False)
+        except Exception:
+            # Unresolvable $refs, patterns Python's re rejects, etc.  Leave schemas that can't be compiled to the api
+            _schema_validators[key] = None
+
+    validator = _schema_validators[key]
+    if validator is not None:
+        # Raises fastjsonschema.JsonSchemaValueException describing the first invalid field
+        validator({name: section for name, section in (("auth", config_set.auth),
+                                                       ("connect", config_set.connect),
+                                                       ("settings", config_set.settings)) if section is not None})
+
+
 # Config schemas define which parameters are available when configuring each integration
 # They are in JsonSchema format defining requirements for auth, connect, and settings config sections (`ConfigSet`)
 def list_integration_access_schemas(platform_id: str, token: str, target_org: Optional[str]=None) -> List[Dict[str, Any]]:
-    headers = {"Authorization": token}
-    if target_org:
-        headers['X-Sevco-Target-Org'] = target_org
+    def fetch() -> List[Dict[str, Any]]:
+        headers = _get_headers(token, target_org)
 
-    resp = requests.get(f"https://api.sev.co/v3/integration-platform/{platform_id}/access/schema", headers=headers)
-    resp.raise_for_status()
+        resp = _get_session().get(_PLATFORM_URL + platform_id + "/access/schema", headers=headers, timeout=_TIMEOUT_SECONDS)
+        resp.raise_for_status()
+
+        schemas = _loads(resp.content)['items']
+        _register_schemas(platform_id, None, schemas)
 
-    return resp.json()['items']
+        return schemas
+
+    return _cached_schemas(platform_id, None, target_org, fetch)
 
 
 def list_integration_schemas(platform_id: str, integration_id: str, token: str, target_org: Optional[str]=None) -> List[Dict[str, Any]]:
-    headers = {"Authorization": token}
-    if target_org:
-        headers['X-Sevco-Target-Org'] = target_org
+    def fetch() -> List[Dict[str, Any]]:
+        headers = _get_headers(token, target_org)
 
-    resp = requests.get(f"https://api.sev.co/v3/integration-platform/{platform_id}/integration/{integration_id}/schema", headers=headers)
-    resp.raise_for_status()
+        resp = _get_session().get(_PLATFORM_URL + platform_id + "/integration/" + integration_id + "/schema", headers=headers, timeout=_TIMEOUT_SECONDS)
+        resp.raise_for_status()
+
+        schemas = _loads(resp.content)['items']
+        _register_schemas(platform_id, integration_id, schemas)
 
-    return resp.json()['items']
+        return schemas
+
+    return _cached_schemas(platform_id, integration_id, target_org, fetch)
 
 
 def create_integration_access_config(platform_id: str,
-                                     create_request: CreateIntegrationAccessConfigRequest,
+                                     create_request: Optional[CreateIntegrationAccessConfigRequest],
                                      token: str,
-                                     target_org: Optional[str]=None) -> AccessConfig:
-    headers = {"Authorization": token}
-    if target_org:
-        headers['X-Sevco-Target-Org'] = target_org
-
-    resp = requests.post(f"https://api.sev.co/v3/integration-platform/{platform_id}/access/config", headers=headers, json=asdict(create_request))
+                                     target_org: Optional[str]=None,
+                                     *,
+                                     body: Optional[bytes]=None) -> AccessConfig:
+    if (create_request is None) == (body is None):
+        raise ValueError("exactly one of create_request or body must be given")
+
+    headers = _get_headers(token, target_org, json_body=True)
+    if body is None:
+        _validate_config_set(platform_id, None, create_request.config_set)
+        body = encode_request(create_request)
+
+    resp = _get_session().post(_PLATFORM_URL + platform_id + "/access/config", headers=headers, data=body, timeout=_TIMEOUT_SECONDS)
     resp.raise_for_status()
 
-    params = resp.json()
-
-    return AccessConfig(org_id=params['org_id'],
-                        platform_id=params['platform_id'],
-                        id=params['id'],
-                        config_set=params['config_set'],
-                        enabled=params['enabled'],
-                        created_timestamp=params['created_timestamp'],
-                        last_updated_timestamp=params['last_updated_timestamp'],
-                        runner_id=params.get("runner_id"),
-                        label=params.get('label'),
-                        contact_info=params.get('contact_info'),
-                        external_console_link=params.get('external_console_link'))
+    return _build_access_config(_loads(resp.content))
 
 
 def create_integration_config(platform_id: str,
                               integration_id: str,
-                              create_request: CreateIntegrationConfigRequest,
+                              create_request: Optional[CreateIntegrationConfigRequest],
                               token: str,
-                              target_org: Optional[str]) -> IntegrationConfig:
-    headers = {"Authorization": token}
-    if target_org:
-        headers['X-Sevco-Target-Org'] = target_org
-
-    resp = requests.post(f"https://api.sev.co/v3/integration-platform/{platform_id}/integration/{integration_id}/config", headers=headers, json=asdict(create_request))
+                              target_org: Optional[str],
+                              *,
+                              body: Optional[bytes]=None) -> IntegrationConfig:
+    if (create_request is None) == (body is None):
+        raise ValueError("exactly one of create_request or body must be given")
+
+    headers = _get_headers(token, target_org, json_body=True)
+    if body is None:
+        _validate_config_set(platform_id, integration_id, create_request.config_set)
+        body = encode_request(create_request)
+
+    resp = _get_session().post(_PLATFORM_URL + platform_id + "/integration/" + integration_id + "/config", headers=headers, data=body, timeout=_TIMEOUT_SECONDS)
     resp.raise_for_status()
 
-    params = resp.json()
+    return _build_integration_config(_loads(resp.content))
 
-    return IntegrationConfig(org_id=params['org_id'],
-                             platform_id=params['platform_id'],
-                             integration_id=params['integration_id'],
-                             id=params['id'],
-                             access_config_id=params['access_config_id'],
-                             config_set=params['config_set'],
-                             enabled=params['enabled'],
-                             created_timestamp=params['created_timestamp'],
-                             last_updated_timestamp=params['last_updated_timestamp'],
-                             label=params.get('label'))
 
-def get_latest_execution(integration_config_id: str, token: str, target_org: Optional[str]) -> Dict[str, Any]:
-    headers = {"Authorization": token}
-    if target_org:
-        headers['X-Sevco-Target-Org'] = target_org
+# Raised by `create_integration_configs_bulk` when some creates fail.  `created` and `errors` line up with the
+# submitted requests, so the ids of configs that were created are not lost
+class BulkCreateError(Exception):
+    def __init__(self, created: List[Optional[IntegrationConfig]], errors: List[Optional[Exception]]):
+        failed = sum(error is not None for error in errors)
+        super().__init__(f"{failed} of {len(errors)} integration configs failed to create")
+        self.created = created
+        self.errors = errors
 
-    resp = requests.get("https://api.sev.co/v1/integration/execution",
-                        params={'context_id': integration_config_id, 'count': 1, 'sort_ascending': 'false'},
-                        headers=headers)
-    resp.raise_for_status()
 
-    return resp.json()['items'][0]
+# Integration configs sharing an access config don't depend on each other, so they can be created concurrently.
+# Every request is validated before any is posted so an invalid one can't leave the others half created.
+# If any post fails the others still run to completion and a `BulkCreateError` carrying every outcome is raised.
+# Results are returned in the same order as `create_requests`
+def create_integration_configs_bulk(platform_id: str,
+                                    integration_id: str,
+                                    create_requests: List[CreateIntegrationConfigRequest],
+                                    token: str,
+                                    target_org: Optional[str]) -> List[IntegrationConfig]:
+    for create_request in create_requests:
+        _validate_config_set(platform_id, integration_id, create_request.config_set)
+    bodies = [encode_request(create_request) for create_request in create_requests]
+
+    with ThreadPoolExecutor(max_workers=_MAX_CONCURRENT_REQUESTS) as executor:
+        futures = [executor.submit(create_integration_config, platform_id, integration_id, None,
+                                   token=token, target_org=target_org, body=body)
+                   for body in bodies]
+
+    errors = [future.exception() for future in futures]
+    created = [future.result() if error is None else None for future, error in zip(futures, errors)]
+    if any(error is not None for error in errors):
+        raise BulkCreateError(created, errors) from next(error for error in errors if error is not None)
+
+    return created
+
+
+def get_latest_execution(integration_config_id: str, token: str, target_org: Optional[str]) -> Dict[str, Any]:
+    headers = _get_headers(token, target_org)
+
+    resp = _get_session().get(_EXECUTION_URL,
+                               params={'context_id': integration_config_id, 'count': 1, 'sort_ascending': 'false'},
+                               headers=headers,
+                               stream=True,
+                               timeout=_TIMEOUT_SECONDS)
+    if not resp.ok:
+        resp.close()  # The streamed body is never read on failure, so release the connection before raising
+        resp.raise_for_status()
+
+    if ijson is None:
+        return _loads(resp.content)['items'][0]
+
+    # Only the first execution is needed, so stop parsing as soon as it has been read
+    resp.raw.decode_content = True
+    try:
+        for execution in ijson.items(resp.raw, 'items.item', use_float=True):
+            return execution
+        raise IndexError("no executions found")
+    finally:
+        # Discard the rest of the body without parsing it so the connection goes back to the pool
+        resp.raw.drain_conn()
     
 
+# Results are printed as indented JSON, encoded in one pass and written straight to stdout's byte buffer
+def _print_json(title: str, obj: Any) -> None:
+    if is_dataclass(obj):
+        obj = asdict(obj)
+    if orjson is not None:
+        encoded = orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+    else:
+        encoded = json.dumps(obj, indent=2, sort_keys=True).encode()
+
+    sys.stdout.flush()
+    sys.stdout.buffer.write(title.encode() + b"\n" + encoded + b"\n")
+
+
 def main(token: str, target_org: Optional[str]):
-    access_schemas = list_integration_access_schemas('sentinelone', token=token, target_org=target_org)
-    print("Access Schemas:")
-    pprint(access_schemas)
+    # The schema listings don't depend on each other or on any created config, so fetch them concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        access_schemas_future = executor.submit(list_integration_access_schemas, 'sentinelone', token=token, target_org=target_org)
+        integration_schemas_future = executor.submit(list_integration_schemas, 'sentinelone', 'sentinelone', token=token, target_org=target_org)
+        access_schemas = access_schemas_future.result()
+        integration_schemas = integration_schemas_future.result()
+
+    _print_json("Access Schemas:", access_schemas)
     # Example JsonSchemas for SentinelOne access configs:
     # [{'$defs': {'auth': {'$id': '/schemas/auth',
     #                  'additionalProperties': False,
@@ -192,12 +495,9 @@ def main(token: str, target_org: Optional[str]):
                                                                                           enabled=True,
                                                                                           label="My SentinelOne Connection"),
                                                      token=token, target_org=target_org)
-    print("Access Config:")
-    pprint(access_config)
+    _print_json("Access Config:", access_config)
 
-    integration_schemas = list_integration_schemas('sentinelone', 'sentinelone', token=token, target_org=target_org)
-    print("Integration Schemas:")
-    pprint(integration_schemas)
+    _print_json("Integration Schemas:", integration_schemas)
     # Example JsonSchemas for SentinelOne integration configs:
     # [{'$defs': {'settings': {'$id': '/schemas/settings',
     #                          'additionalProperties': False,
@@ -261,12 +561,10 @@ def main(token: str, target_org: Optional[str]):
                                                    token=token,
                                                    target_org=target_org)
 
-    print("Integration Config:")
-    pprint(integration_config)
+    _print_json("Integration Config:", integration_config)
 
     execution = get_latest_execution(integration_config.id, token=token, target_org=target_org)
-    print("Execution:")
-    pprint(execution)
+    _print_json("Execution:", execution)
 
 
 if __name__ == "__main__":